@@ -1,4 +1,7 @@
-
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import cv2
@@ -15,53 +18,136 @@ class ClassicImageProcessor():
     - Adaptative Threshold
     - Gaussian Blur
 
-    - ConnectedComponents to extract the ROI list
+    - ConnectedComponents to extract the ROI list and their bounding boxes
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, use_opencl=False):
+        # Opt-in : frames are processed as cv2.UMat (OpenCL) when a device
+        # is available. OpenCL kernels are not guaranteed to round exactly
+        # like the CPU ones, so the ROI could depend on the machine.
+        self.use_opencl = use_opencl and cv2.ocl.haveOpenCL()
+        # Per worker thread scratch buffers
+        self._scratch = threading.local()
 
     def predict(self, X):
         """
-        All operations are done inplace to save memory space.
+        Frames are independent and every OpenCV call releases the GIL,
+        so they are processed in parallel by a pool of threads.
+
+        :param: X : sequence of frames of the same size, e.g. the (N, H, W, C)
+                    array returned by get_images_from_tif or a list of frames
+
+        :return: list of (markers, stats) pairs, markers are views of a single
+                 (N, H, W) labels array
         """
-        Y = []
-        for img in X:
-            # Background suppression
-            img = self._suppress_background(img)
-            # Convert to grayscale
-            img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-            # LoG Filter
-            img = self._LoG_filter(img)
-            # TOZERO Threshold
-            _, img = cv2.threshold(img, 25, 255, cv2.THRESH_TOZERO)
-            # Adaptative Threshold
-            img = cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY,11,0)
-            # Median Blur
-            img = cv2.medianBlur(img, 5)
-            # ConnectedComponents
-            _, img = cv2.connectedComponents(img)
-            Y.append(img)
+        markers = np.empty((len(X),) + X[0].shape[:2], np.int32) if len(X) else []
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            Y = list(executor.map(self._process_one, X, markers))
         return Y
 
+    def predict_iter(self, X):
+        """
+        Stream version of predict, for an iterable of frames
+        (see iter_images_from_tif).
 
-    def _suppress_background(self, img):
-        # D'abord on supprime le background
-        background_top = np.mean(img[:,0:10,:], axis=1)
-        background_bot = np.mean(img[:,-10:,:], axis=1)
-        background = (background_top + background_bot) / 2
+        At most 2 frames per worker are pulled from X ahead of the consumer,
+        so decoding, processing and the consumer of the results overlap
+        and only a few frames are in memory at the same time.
 
-        img = img - background
-        return cv2.convertScaleAbs(img)
+        :return: generator of (markers, stats) pairs, in the order of X
+        """
+        # os.cpu_count() returns None when the count can not be determined
+        max_workers = os.cpu_count() or 1
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for img in X:
+                markers = np.empty(img.shape[:2], np.int32)
+                pending.append(executor.submit(self._process_one, img, markers))
+                if len(pending) >= 2 * max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _process_one(self, img, markers):
+        """
+        All operations are done inplace to save memory space.
+
+        With OpenCL, every intermediate image stays on the device,
+        only the image given to connectedComponents is pulled back to the host.
+        """
+        size = img.shape[:2]
+        if self.use_opencl:
+            img = cv2.UMat(img)
+        # Background suppression
+        img = self._suppress_background(img, size)
+        # Convert to grayscale
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY, dst=self._scratch_buffer('gray', size))
+        # LoG Filter
+        img = self._LoG_filter(img)
+        # TOZERO Threshold (pixel-wise, safe to run inplace)
+        cv2.threshold(img, 25, 255, cv2.THRESH_TOZERO, dst=img)
+        # Adaptative Threshold (the mean is computed in its own buffer
+        # before the pixel-wise comparison, safe to run inplace)
+        cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY,11,0, dst=img)
+        # Median Blur (reads neighbours, needs its own output)
+        img = cv2.medianBlur(img, 5)
+        # ConnectedComponents, stats hold the bounding box of each label.
+        # It has no OpenCL implementation, it runs on the host either way.
+        if self.use_opencl:
+            img = img.get()
+        _, _, stats, _ = cv2.connectedComponentsWithStats(img, labels=markers)
+        return markers, stats
+
+    def _scratch_buffer(self, name, shape):
+        """
+        Return the uint8 scratch buffer `name` of the current worker thread.
+
+        Frames of a TIF share their size : the buffer is allocated once
+        per worker thread and reused for every following frame.
+        With OpenCL, OpenCV manages the device buffers : None is returned.
+        """
+        if self.use_opencl:
+            return None
+        buf = getattr(self._scratch, name, None)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, np.uint8)
+            setattr(self._scratch, name, buf)
+        return buf
+
+    def _suppress_background(self, img, size):
+        # D'abord on supprime le background
+        # Everything stays in uint8 : no float64 temporaries
+        # Strips are reduced in per thread scratch buffers, no slice copy
+        height, width = size
+        strip_shape = (height, 1, 3)
+        background_top = cv2.reduce(self._columns(img, height, 0, 10), 1, cv2.REDUCE_AVG,
+                                    dst=self._scratch_buffer('background_top', strip_shape))
+        background_bot = cv2.reduce(self._columns(img, height, width-10, width), 1, cv2.REDUCE_AVG,
+                                    dst=self._scratch_buffer('background_bot', strip_shape))
+        # Pixel-wise, safe to run inplace
+        background = cv2.addWeighted(background_top, 0.5, background_bot, 0.5, 0, dst=background_top)
+
+        # Each row gets its own background.
+        # cv2.absdiff gives |img - background| in uint8, like convertScaleAbs did
+        background = cv2.repeat(background, 1, width,
+                                dst=self._scratch_buffer('background', (height, width, 3)))
+        return cv2.absdiff(img, background)
+
+    @staticmethod
+    def _columns(img, height, start, stop):
+        # UMat can not be sliced like a ndarray, a ROI header is used instead
+        if isinstance(img, cv2.UMat):
+            return cv2.UMat(img, (0, height), (start, stop))
+        return img[:, start:stop]
 
     def _LoG_filter(self, img):
-        kernel = np.array([[1,1,1],
-                           [1,-8,1],
-                           [1,1,1]])
+        # img - laplacian is folded into the kernel : identity - laplacian
+        kernel = np.array([[-1,-1,-1],
+                           [-1, 9,-1],
+                           [-1,-1,-1]])
         img = cv2.GaussianBlur(img, (5,5), 0)
-        laplacian = cv2.filter2D(img,cv2.CV_32F,kernel)
-        img = np.float32(img)
-        return cv2.convertScaleAbs(img - laplacian)
+        img = cv2.filter2D(img, cv2.CV_16S, kernel)
+        return cv2.convertScaleAbs(img)
 
 
 if __name__ == '__main__':
@@ -73,7 +159,7 @@ if __name__ == '__main__':
 
     results = processor.predict(images)
 
-    for k, img in enumerate(results):
+    for k, (img, _) in enumerate(results):
         im = np.where(img != 0, 255, 0)
         cv2.imwrite(".//data//{}.tif".format(k+1), im)
 
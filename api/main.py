@@ -5,7 +5,7 @@ import numpy as np
 
 from django.conf import settings
 
-from .utils.utils import get_rois_from_markers, get_images_from_tif
+from .utils.utils import get_rois_from_markers, iter_images_from_tif
 from .utils.roi import ROIEncoder
 from .classicImageProcessor import ClassicImageProcessor
 
@@ -15,17 +15,17 @@ def main(input_file_path):
     filename, ext = os.path.splitext(fullfilename)
 
     if ext == '.tif':
-        images = get_images_from_tif(input_file_path)
+        # Pages are decoded in the background while the first ones are processed
+        images = iter_images_from_tif(input_file_path)
     else:
         return None
 
     processor = ClassicImageProcessor()
 
-    markers_list = processor.predict(images)
-
+    # ROI are extracted from a frame while the next ones are processed
     rois = []
-    for k, markers in enumerate(markers_list):
-        rois += get_rois_from_markers(markers, k+1)
+    for k, (markers, stats) in enumerate(processor.predict_iter(images)):
+        rois += get_rois_from_markers(markers, stats, k+1)
 
     encoder = ROIEncoder()
 
@@ -1,3 +1,26 @@
 from django.test import TestCase
 
-# Create your tests here.
+import numpy as np
+
+from .classicImageProcessor import ClassicImageProcessor
+
+
+class SuppressBackgroundTest(TestCase):
+
+    def test_absolute_difference_with_row_background(self):
+        # Non square frame, strips are constant per row so that the
+        # background of row j is exactly (left[j] + right[j]) / 2
+        height, width = 6, 30
+        rng = np.random.RandomState(0)
+        img = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        left = rng.randint(0, 128, (height, 1, 3)).astype(np.uint8) * 2
+        right = rng.randint(0, 128, (height, 1, 3)).astype(np.uint8) * 2
+        img[:, :10] = left
+        img[:, -10:] = right
+        background = (left.astype(np.int16) + right) // 2
+
+        expected = np.abs(img.astype(np.int16) - background).astype(np.uint8)
+
+        processor = ClassicImageProcessor(use_opencl=False)
+        result = processor._suppress_background(img, (height, width))
+        np.testing.assert_array_equal(result, expected)
@@ -17,8 +17,8 @@ Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 0211
 import numpy as np
 
 import struct
-import re
 from collections import namedtuple
+from functools import lru_cache
 import os
 import zipfile
 
@@ -78,21 +78,20 @@ class ROIShape(ROIObject):
         super().__init__(top, left, bottom, right, name, position)
 
     def get_shapeArray(self):
-        shapeArray = list()
-        shapeArray.append(0.0)
-        for x,y in zip(self.x_coords, self.y_coords):
-            shapeArray.append(float(y))
-            shapeArray.append(float(x))
-            shapeArray.append(1.0)
-        shapeArray.pop()
-        shapeArray.append(4.0)
+        # [0, y0, x0, 1, y1, x1, 1, ..., yn, xn, 4]
+        n = len(self.x_coords)
+        shapeArray = np.empty(3*n + 1, np.float32)
+        shapeArray[0] = 0.0
+        shapeArray[1::3] = self.y_coords
+        shapeArray[2::3] = self.x_coords
+        shapeArray[3::3] = 1.0
+        shapeArray[-1] = 4.0
         return shapeArray
 
     @staticmethod
     def get_coords_from_shapeArray(shapeArray):
-        x_coords = [value for index, value in enumerate(shapeArray) if index%3==2]
-        y_coords = [value for index, value in enumerate(shapeArray) if index%3==1]
-        return x_coords, y_coords
+        shapeArray = np.asarray(shapeArray, np.float32)
+        return shapeArray[2::3], shapeArray[1::3]
 
 
 
@@ -100,6 +99,24 @@ class ROIShape(ROIObject):
 HeaderTuple = namedtuple('Header_variables', 'type size offset')
 
 
+def _type_size(_type):
+    sizes = {'h': 2, 'f': 4, 'i': 4, 's': 1, 'b': 1}
+    size = sizes[_type[-1]]
+    if _type[0].isdigit():
+        size *= int(_type[:-1])
+    return size
+
+
+def _header_dict(fields):
+    return {e[0]: HeaderTuple(e[1], _type_size(e[1]), e[2]) for e in fields}
+
+
+@lru_cache(maxsize=None)
+def _packer(var_type):
+    # Big endian Struct, compiled once per type ('h', 'f', ..., '12s')
+    return struct.Struct('>' + var_type)
+
+
 class ROIFileObject(object):
 
     _header1_fields = [
@@ -161,53 +178,37 @@ class ROIFileObject(object):
     _roi_types = {0: 'polygon', 1: 'rect', 2: 'oval', 3: 'line', 4: 'freeline', 5: 'polyline', 6: 'no_roi',
                   7: 'freehand', 8: 'traces', 9: 'angle', 10: 'point'}
 
-    def __init__(self):
-        self._header1_dict = {e[0]: HeaderTuple(e[1], self._type_size(e[1]), e[2]) for e in self._header1_fields}
-        self._header2_dict = {e[0]: HeaderTuple(e[1], self._type_size(e[1]), e[2]) for e in self._header2_fields}
-    
-    @staticmethod
-    def _type_size(_type):
-        sizes = {'h': 2, 'f': 4, 'i': 4, 's': 1, 'b': 1}
-        char = re.findall(r'\D', _type)[0]
-        size = sizes[char]
-        number = re.findall(r'\d', _type)
-
-        if number:
-            size *= int(number[0])
-        return size
+    # Built once, when the class is defined
+    _header1_dict = _header_dict(_header1_fields)
+    _header2_dict = _header_dict(_header2_fields)
 
 
 class ROIEncoder(ROIFileObject):
 
-    def write(self, path, roi_obj):
+    def encode(self, roi_obj):
         self.roi_obj = roi_obj
         self.header2_offset = self._header1_size
 
-        self.f_obj = open(path, 'wb')
-        pad = struct.pack('128b', *np.zeros(128, np.int8))
-        self.f_obj.write(pad)
+        # The whole ROI record is built in memory.
+        # Shape writers extend the buffer with their coordinates.
+        self._buf = bytearray(self._header1_size + self._header2_size + len(self.roi_obj.name))
 
         self._write_header('MAGIC', b'Iout')
         self._write_header('VERSION_OFFSET', 225)  # todo or 226??
 
         roi_writer = getattr(self, '_write_roi_' + self.roi_obj.type)
         roi_writer()
-        
-        self.f_obj.close()
+
+        return bytes(self._buf)
+
+    def write(self, path, roi_obj):
+        with open(path, 'wb') as f_obj:
+            f_obj.write(self.encode(roi_obj))
 
     def write_zip(self, arc_path, rois):
-        import shutil
-        dir_name = os.path.dirname(arc_path)
-        arc_name = os.path.splitext(os.path.basename(arc_path))[0]
-        temp_dir_name = "{}//RoiSet_{}".format(dir_name, arc_name[:-4])
-        os.mkdir(temp_dir_name)
-        zf = zipfile.ZipFile(arc_path, 'w', zipfile.ZIP_DEFLATED)
-        for roi in rois:
-            file_path = "{}//{}.roi".format(temp_dir_name, roi.name)
-            self.write(file_path, roi)
-            zf.write(file_path)
-        shutil.rmtree(temp_dir_name)
-        zf.close()
+        with zipfile.ZipFile(arc_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for roi in rois:
+                zf.writestr('{}.roi'.format(roi.name), self.encode(roi))
 
     def _write_roi_rect(self):
         self._write_header('TYPE', self._roi_types_rev[self.roi_obj.type])
@@ -231,9 +232,8 @@ class ROIEncoder(ROIFileObject):
         self._write_header('SHAPE_ROI_SIZE', len(shapeArray))
 
         base = self.header2_offset #TODO
-        for f in shapeArray:
-            self._write_var(base, 'f', f)
-            base += 4
+        # Insert the big endian coordinates block in one go
+        self._buf[base:base] = shapeArray.astype('>f4').tobytes()
 
         self.header2_offset = self.header2_offset + 4 * len(shapeArray)
         self._write_header('HEADER2_OFFSET', self.header2_offset)
@@ -281,10 +281,8 @@ class ROIEncoder(ROIFileObject):
         
         self._write_var(offset, header.type, value)
 
-    def _write_var(self, offset, var_type, value):
-        self.f_obj.seek(offset)
-        binary = struct.pack('>' + var_type, value)
-        self.f_obj.write(binary)
+    def _write_var(self, offset, var_type, *values):
+        _packer(var_type).pack_into(self._buf, offset, *values)
 
     def _write_name(self):
         offset = self._header2_size + self.header2_offset
@@ -370,11 +368,8 @@ class ROIDecoder(ROIFileObject):
         n = self.header['SHAPE_ROI_SIZE']
 
         base = 64 #TODO
-        shapeArray = list()
-        for _ in range(n):
-            shapeArray.append(self._get_var(base, 4, 'f'))
-            base += 4
-        
+        shapeArray = np.frombuffer(self.data, '>f4', n, base)
+
         x_coords, y_coords = ROIShape.get_coords_from_shapeArray(shapeArray)
         return ROIShape(x_coords, y_coords, self.name,  position, top, left, bottom, right)
 
@@ -421,8 +416,7 @@ class ROIDecoder(ROIFileObject):
         return self._get_var(offset, header.size, header.type)
     
     def _get_var(self, offset, var_size, var_type):
-        binary = self.data[offset:offset+var_size]
-        return struct.unpack('>' + var_type, binary)[0]  # read header variable, big endian
+        return _packer(var_type).unpack_from(self.data, offset)[0]  # read header variable, big endian
 
     def _set_header(self, header_name):
         self.header[header_name] = self._get_header(header_name)
@@ -1,3 +1,6 @@
+import queue
+import threading
+
 import numpy as np
 import cv2
 from PIL import Image
@@ -8,31 +11,98 @@ def get_images_from_tif(file):
 
     :param: file : File object, pathlib.Path object or filename (string)
     
-    :return: list of images inside the TIF file
+    :return: array of shape (n_frames, H, W, C) holding the images inside the TIF file
+    """
+    with Image.open(file) as multi_img:
+        # All pages share the shape of the first one : a single buffer
+        # is allocated and every page is decoded into its own slice
+        first = np.asarray(multi_img)
+        images = np.empty((multi_img.n_frames,) + first.shape, first.dtype)
+        images[0] = first
+        for k in range(1, multi_img.n_frames):
+            multi_img.seek(k)
+            images[k] = np.asarray(multi_img)
+    return images
+
+def iter_images_from_tif(file, buffer_size=2):
     """
-    multi_img = Image.open(file)
-    images_list = []
-    for k in range(multi_img.n_frames):
-        multi_img.seek(k)
-        images_list.append(np.array(multi_img))
-    return images_list
-
-def get_rois_from_markers(markers, frame_position=0):
+    Read a multi-pages TIF file page by page.
+
+    Pages are decoded by a background thread while the previous ones
+    are processed, at most `buffer_size` decoded pages wait in memory.
+
+    :param: file : File object, pathlib.Path object or filename (string)
+    :param: buffer_size : number of decoded pages waiting to be consumed
+
+    :return: generator of the images inside the TIF file
+    """
+    frames = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up if the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            with Image.open(file) as multi_img:
+                for k in range(multi_img.n_frames):
+                    multi_img.seek(k)
+                    if not put(np.array(multi_img)):
+                        return
+        except Exception as e:
+            put(e)
+        put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = frames.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+def get_rois_from_markers(markers, stats, frame_position=0):
     """
-    #TODO
+    Extract one ROIShape per label of a markers image.
+
+    :param: markers : labels image returned by cv2.connectedComponentsWithStats
+    :param: stats : stats array returned by cv2.connectedComponentsWithStats
+    :param: frame_position : position of the frame inside the TIF file
+
+    :return: list of ROIShape
     """
+    from api.utils.roi import ROIShape
+
+    rows, cols = markers.shape
+    # Only scan the bounding box of each label, with a 1 pixel margin
+    # so the contour never lies on the border of the crop.
+    # Boxes are computed once for all labels, as plain python ints.
+    x, y, w, h = stats[1:, :4].T
+    boxes = zip(np.maximum(y-1, 0).tolist(), np.minimum(y+h+1, rows).tolist(),
+                np.maximum(x-1, 0).tolist(), np.minimum(x+w+1, cols).tolist())
     rois = []
-    for k in range(markers.max()):
-        mask = np.uint8(np.where(markers==k+1,1,0))
-        _,cnt,_ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # stats has one row per label (background included) : no need
+    # for a full image markers.max() to know the number of labels
+    for k, (y0, y1, x0, x1) in enumerate(boxes):
+        # bool and uint8 share the same layout, the view is free
+        mask = np.equal(markers[y0:y1, x0:x1], k+1).view(np.uint8)
+        _,cnt,_ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
         cnt = np.reshape(cnt[0], (-1,2))
         y_coords = cnt[:,0]
         x_coords = cnt[:,1]
-        from api.utils.roi import ROIShape
         roi = ROIShape(x_coords, y_coords, "roi-{:04d}-{:04d}".format(frame_position, k), frame_position)
         rois.append(roi)
     return rois
-        
-
-
-